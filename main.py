@@ -1,34 +1,64 @@
 import os
+import re
+import asyncio
 import logging
-import threading
+import collections
+import functools
 import html
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 import asyncpg
 from telegram.constants import ParseMode
+from telegram.error import Forbidden, RetryAfter
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 # --- Web Server for Render Health Checks ---
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"OK")
-
-def run_web_server():
-    port = int(os.environ.get("PORT", 8080))
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, HealthCheckHandler)
-    logger.info(f"Starting web server on port {port}")
-    httpd.serve_forever()
+# Served from the bot's own event loop instead of a separate HTTPServer thread.
+# Render only needs a 200, so the request is drained but never parsed.
+HEALTH_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
+
+async def handle_health_check(reader, writer):
+    try:
+        # Read what the probe sent so closing doesn't reset the connection before it sees the reply
+        await reader.read(1024)
+        writer.write(HEALTH_RESPONSE)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_web_server():
+    server = await asyncio.start_server(handle_health_check, port=PORT)
+    logger.info(f"Starting web server on port {PORT}")
+    return server
 
 # --- Configuration ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID = int(os.environ.get("ADMIN_ID"))
 DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOLER = "-pooler" in (DATABASE_URL or "")  # Neon pgbouncer endpoint
 CHANNEL_ID = int(os.environ.get("CHANNEL_ID", "0"))
+PORT = int(os.environ.get("PORT", 8080))
+# When set, Telegram pushes updates to WEBHOOK_URL/<BOT_TOKEN> on PORT instead of the bot long-polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WH_SECRET")
 RAZORPAY_LINK = "razorpay.me/@gateprep"
+USER_ID_RE = re.compile(r"\(ID: `?(\d+)`?\)")
+CONCURRENT_UPDATES = 32
+FLUSH_INTERVAL = 5
+SEEN_USERS_SIZE = 50000
+VACUUM_VISIBLE_THRESHOLD = 0.9
+DEMO_CACHE_RETRY = 600
+BROADCAST_CONCURRENCY = 30  # Telegram allows ~30 msg/s per bot
+BROADCAST_BATCH = 1000
+BROADCAST_RETRIES = 3
+ADMIN_FWD_MAP_SIZE = 10000
 
 # --- Logging Setup ---
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -82,69 +112,306 @@ COURSES = {
     }
 }
 
+# --- Precomputed Menus ---
+for c in COURSES.values():
+    c["name_html"] = html.escape(c["name"])
+    if "description" in c:
+        c["menu_text"] = f"📚 <b>{c['name_html']}</b>\n\n{c['description']}\n\nSelect below to explore free demos or proceed to purchase:"
+    else:
+        c["menu_text"] = (
+            f"📚 <b>{c['name_html']}</b>\n\n"
+            "<b>What you will get:</b> Complete video lectures and high-quality PDF materials for all the subjects listed below.\n\n"
+            "Select a subject to explore free demos or proceed to purchase:"
+        )
+    c["buy_text"] = f"✅ <b>Purchase {c['name_html']}</b>\n\n<b>Price: ₹{c['price']}</b>\n\nPay via Razorpay and share your screenshot here."
+    for subj in c["subjects"].values():
+        subj["name_html"] = html.escape(subj["name"])
+
+# Everything in the welcome message after the user's name
+WELCOME_BODY = (
+    "<b>📖 How to use this platform:</b>\n"
+    "1. Select your target exam category below.\n"
+    "2. Choose a subject to view free demo lectures and study materials.\n"
+    "3. Purchase to access full course.\n\n"
+    "🌟 <b>Note:</b> These courses feature premium, high-quality lectures from <b>Web Sankul Academy</b> to ensure top-tier preparation.\n\n"
+    "Please select a course category below to begin:"
+)
+
+# Flat (course_key, subj_key) -> subject map, with the rendered texts the handlers need
+SUBJECT_INDEX = {}
+for ck, c in COURSES.items():
+    for sk, subj in c["subjects"].items():
+        SUBJECT_INDEX[(ck, sk)] = {
+            **subj,
+            "menu_text": (
+                f"📘 <b>{c['name_html']} &gt; {subj['name_html']}</b>\n\n"
+                "Evaluate the content quality before you commit. Watch the demo video or read the demo PDF provided by Web Sankul Academy.\n\n"
+                "Choose an action below:"
+            ),
+            "followup_text": f"Liked the demo? Unlock the complete Web Sankul Academy course for {c['name_html']} below:"
+        }
+
+@functools.lru_cache(maxsize=4096)
+def esc(text):
+    # Cached html.escape for repeat values such as users' first names
+    return html.escape(text)
+
+# COURSES never changes at runtime, so the keyboards are built once and shared
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(c["name"], callback_data=ck)] for ck, c in COURSES.items()])
+
+COURSE_MARKUPS = {
+    ck: InlineKeyboardMarkup(
+        [[InlineKeyboardButton(subj["name"], callback_data=f"subj_{ck}_{sk}")] for sk, subj in c["subjects"].items()]
+        + [[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
+    )
+    for ck, c in COURSES.items()
+}
+
+SUBJECT_MARKUPS = {
+    (ck, sk): InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎥 Watch Demo Video", callback_data=f"demo_vid_{ck}_{sk}")],
+        [InlineKeyboardButton("📄 View Demo Material", callback_data=f"demo_mat_{ck}_{sk}")],
+        [InlineKeyboardButton("🛒 Buy Full Course", callback_data="buy_course")],
+        [InlineKeyboardButton("💬 Talk to Admin", callback_data="talk_admin")],
+        [InlineKeyboardButton("⬅️ Back to Subjects", callback_data=ck)]
+    ])
+    for ck, c in COURSES.items() for sk in c["subjects"]
+}
+
+DEMO_FOLLOWUP_MARKUPS = {
+    ck: InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛒 Purchase Full Course", callback_data="buy_course")],
+        [InlineKeyboardButton("💬 Talk to Admin to Buy", callback_data="talk_admin")],
+        [InlineKeyboardButton("⬅️ Back to Subjects", callback_data=ck)]
+    ])
+    for ck in COURSES
+}
+
+BUY_MARKUPS = {
+    ck: InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"💳 Pay ₹{c['price']} Now", url=RAZORPAY_LINK)],
+        [InlineKeyboardButton("✅ Already Paid? Share Screenshot", callback_data="share_screenshot")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=ck)]
+    ])
+    for ck, c in COURSES.items()
+}
+
+# callback_data -> everything its handler needs, resolved with a single lookup:
+#   subj_*  -> (course_key, course, subject, subject keyboard)
+#   demo_*  -> (course_key, subject, channel msg_id)
+CALLBACK_TABLE = {}
+for (ck, sk), subj in SUBJECT_INDEX.items():
+    CALLBACK_TABLE[f"subj_{ck}_{sk}"] = (ck, COURSES[ck], subj, SUBJECT_MARKUPS[(ck, sk)])
+    CALLBACK_TABLE[f"demo_vid_{ck}_{sk}"] = (ck, subj, subj["vid_msg_id"])
+    CALLBACK_TABLE[f"demo_mat_{ck}_{sk}"] = (ck, subj, subj["mat_msg_id"])
+
 # --- Database Functions ---
 async def init_db(pool):
     async with pool.acquire() as conn:
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
+                first_name TEXT,
                 joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
             CREATE TABLE IF NOT EXISTS stats (
                 action TEXT PRIMARY KEY,
                 count INT DEFAULT 0
             );
+            CREATE INDEX IF NOT EXISTS stats_count_idx ON stats (count DESC);
+            -- Older databases predate first_name; only take the ALTER TABLE lock when it's missing
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'first_name'
+                ) THEN
+                    ALTER TABLE users ADD COLUMN first_name TEXT;
+                END IF;
+            END $$;
         ''')
-        try:
-            await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT;')
-        except Exception as e:
-            logger.warning(f"DB Alter check: {e}")
 
-async def track_user(pool, user_id, first_name):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO users (user_id, first_name) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET first_name = EXCLUDED.first_name",
-            user_id, first_name
-        )
+async def vacuum_users(pool):
+    # Broadcast reads user_id straight from the primary key index; that index-only scan
+    # degrades to heap reads once much of the table is missing from the visibility map.
+    # Started in the background by post_init so a long vacuum never delays startup.
+    try:
+        async with pool.acquire() as conn:
+            visible = await conn.fetchval("SELECT relallvisible::float / NULLIF(relpages, 0) FROM pg_class WHERE oid = 'users'::regclass")
+            if visible is not None and visible < VACUUM_VISIBLE_THRESHOLD:
+                await conn.execute("VACUUM (ANALYZE) users", timeout=300)
+    except Exception as e:
+        logger.warning(f"DB Vacuum users: {e}")
 
-async def increment_stat(pool, action_name):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO stats (action, count) VALUES ($1, 1) ON CONFLICT (action) DO UPDATE SET count = stats.count + 1",
-            action_name
-        )
+# Analytics writes are buffered in memory and written in batches by flush_loop.
+# Each flush is one unnest() upsert per table, so the statement parse, the
+# round-trip and the row locks are paid once per batch instead of per event.
+# The buffers are swapped synchronously on the event loop, so no lock is needed.
+TRACK_USERS_SQL = (
+    "INSERT INTO users (user_id, first_name) SELECT * FROM unnest($1::bigint[], $2::text[]) "
+    "ON CONFLICT (user_id) DO UPDATE SET first_name = EXCLUDED.first_name "
+    "WHERE users.first_name IS DISTINCT FROM EXCLUDED.first_name"
+)
+INCREMENT_STATS_SQL = (
+    "INSERT INTO stats (action, count) SELECT * FROM unnest($1::text[], $2::int[]) "
+    "ON CONFLICT (action) DO UPDATE SET count = stats.count + EXCLUDED.count"
+)
+
+_user_buf = {}
+_stat_buf = collections.Counter()
+
+# Recently written (user_id -> first_name), so repeat /starts with an unchanged name skip the upsert
+_seen_users = collections.OrderedDict()
+
+def track_user(user_id, first_name):
+    if _seen_users.get(user_id) != first_name:
+        _user_buf[user_id] = first_name
+    _seen_users[user_id] = first_name
+    _seen_users.move_to_end(user_id)
+    if len(_seen_users) > SEEN_USERS_SIZE:
+        _seen_users.popitem(last=False)
+
+def increment_stat(action_name):
+    _stat_buf[action_name] += 1
+
+async def flush_users(pool):
+    global _user_buf
+    if not _user_buf: return
+    items, _user_buf = _user_buf, {}
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                TRACK_USERS_SQL,
+                list(items.keys()), list(items.values())
+            )
+    except (Exception, asyncio.CancelledError) as e:
+        # Put the batch back, including when shutdown cancels flush_loop mid-write
+        for user_id, first_name in items.items():
+            _user_buf.setdefault(user_id, first_name)
+        if isinstance(e, asyncio.CancelledError): raise
+        logger.error(f"Users flush failed: {e}")
+
+async def flush_stats(pool):
+    global _stat_buf
+    if not _stat_buf: return
+    items, _stat_buf = _stat_buf, collections.Counter()
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                INCREMENT_STATS_SQL,
+                list(items.keys()), list(items.values())
+            )
+    except (Exception, asyncio.CancelledError) as e:
+        _stat_buf.update(items)
+        if isinstance(e, asyncio.CancelledError): raise
+        logger.error(f"Stats flush failed: {e}")
+
+async def flush_all(pool):
+    await flush_users(pool)
+    await flush_stats(pool)
+
+async def flush_loop(pool):
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_all(pool)
+
+# --- Demo Media Cache ---
+# Channel msg_id -> (media type, file_id, caption, caption entities). Sending a cached
+# file_id skips the channel lookup copy_message does on every click.
+DEMO_MEDIA = {}
+# msg_id -> earliest time to try caching it again (never, for posts that aren't a video/document)
+_demo_next_attempt = {}
+
+async def cache_demo_message(bot, msg_id):
+    if msg_id in DEMO_MEDIA or _demo_next_attempt.get(msg_id, 0) > time.monotonic():
+        return
+    _demo_next_attempt[msg_id] = time.monotonic() + DEMO_CACHE_RETRY
+    try:
+        # Forwarding is the only way to read a channel post; the copy is deleted straight away
+        msg = await bot.forward_message(chat_id=ADMIN_ID, from_chat_id=CHANNEL_ID, message_id=msg_id, disable_notification=True)
+        if msg.video:
+            DEMO_MEDIA[msg_id] = ("video", msg.video.file_id, msg.caption, msg.caption_entities)
+        elif msg.document:
+            DEMO_MEDIA[msg_id] = ("document", msg.document.file_id, msg.caption, msg.caption_entities)
+        else:
+            _demo_next_attempt[msg_id] = float("inf")
+        await msg.delete()
+    except Exception as e:
+        logger.warning(f"Demo cache: could not cache message {msg_id}: {e}")
+
+async def cache_demo_media(bot):
+    msg_ids = {subj[field] for c in COURSES.values() for subj in c["subjects"].values() for field in ("vid_msg_id", "mat_msg_id")}
+    for msg_id in msg_ids - {0}:
+        await cache_demo_message(bot, msg_id)
+    logger.info(f"Demo cache: {len(DEMO_MEDIA)} media files cached")
 
 # --- Conversation States ---
 SELECTING_ACTION, FORWARD_TO_ADMIN, FORWARD_SCREENSHOT = range(3)
 
+# --- Per-Chat Ordering ---
+# Updates are processed concurrently, but ConversationHandler picks the handler from the
+# stored state and saves the new one around the callback, so each chat's updates must run
+# through Application.process_update one at a time. Other chats still run in parallel.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # PTB's process_update takes its own semaphore before do_process_update, so an update
+    # queued behind its chat's lock would hold a slot other chats could use. That semaphore
+    # is made effectively unlimited and the real cap is taken only once the chat lock is held.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(2 ** 31)
+        self._max_concurrent_updates = max_concurrent_updates  # what Application.concurrent_updates reports
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [lock, updates holding or waiting on it]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if not chat:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # --- Handlers ---
+# user_data['last_view'] is (message_id, view) for the menu message last edited by a callback;
+# handlers that edit it into anything else drop the entry
+def is_current_view(query, context: ContextTypes.DEFAULT_TYPE, view):
+    return context.user_data.get('last_view') == (query.message.message_id, view)
+
+async def edit_view(query, context: ContextTypes.DEFAULT_TYPE, view, **kwargs):
+    # Dropped first: an edit that fails locally (e.g. TimedOut) may still have landed, and a
+    # stale entry would then make is_current_view skip the edit back on every press
+    context.user_data.pop('last_view', None)
+    await query.edit_message_text(parse_mode=ParseMode.HTML, **kwargs)
+    context.user_data['last_view'] = (query.message.message_id, view)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     pool = context.bot_data.get('db_pool')
     if pool:
-        await track_user(pool, user.id, user.first_name)
-        await increment_stat(pool, "bot_starts")
-    
-    keyboard = [
-        [InlineKeyboardButton(COURSES["c_gsssb"]["name"], callback_data="c_gsssb")],
-        [InlineKeyboardButton(COURSES["c_gpsc"]["name"], callback_data="c_gpsc")],
-        [InlineKeyboardButton(COURSES["c_gs2026"]["name"], callback_data="c_gs2026")]
-    ]
+        track_user(user.id, user.first_name)
+        increment_stat("bot_starts")
     
-    welcome_text = (
-        f"👋 Welcome, <b>{html.escape(user.first_name)}</b>!\n\n"
-        "<b>📖 How to use this platform:</b>\n"
-        "1. Select your target exam category below.\n"
-        "2. Choose a subject to view free demo lectures and study materials.\n"
-        "3. Purchase to access full course.\n\n"
-        "🌟 <b>Note:</b> These courses feature premium, high-quality lectures from <b>Web Sankul Academy</b> to ensure top-tier preparation.\n\n"
-        "Please select a course category below to begin:"
-    )
+    welcome_text = f"👋 Welcome, <b>{esc(user.first_name)}</b>!\n\n{WELCOME_BODY}"
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        await edit_view(update.callback_query, context, "main_menu", text=welcome_text, reply_markup=MAIN_MENU_MARKUP)
     else:
-        await update.message.reply_text(welcome_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
     return SELECTING_ACTION
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -159,87 +426,73 @@ async def course_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     if not course: return SELECTING_ACTION
     
     pool = context.bot_data.get('db_pool')
-    if pool: await increment_stat(pool, f"view_{course_key}")
+    if pool: increment_stat(f"view_{course_key}")
 
-    keyboard = [[InlineKeyboardButton(subj["name"], callback_data=f"subj_{course_key}_{sk}")] for sk, subj in course["subjects"].items()]
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")])
-    
-    if "description" in course:
-        text = f"📚 <b>{html.escape(course['name'])}</b>\n\n{course['description']}\n\nSelect below to explore free demos or proceed to purchase:"
-    else:
-        text = (
-            f"📚 <b>{html.escape(course['name'])}</b>\n\n"
-            "<b>What you will get:</b> Complete video lectures and high-quality PDF materials for all the subjects listed below.\n\n"
-            "Select a subject to explore free demos or proceed to purchase:"
-        )
-        
-    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    # Pressing the same course button twice would only get "message is not modified" back
+    if is_current_view(query, context, course_key): return SELECTING_ACTION
+    await edit_view(query, context, course_key, text=course['menu_text'], reply_markup=COURSE_MARKUPS[course_key])
     return SELECTING_ACTION
 
 async def subject_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    parts = query.data.split('_')
-    course_key, subj_key = f"{parts[1]}_{parts[2]}", f"{parts[3]}_{parts[4]}"
-    
-    course = COURSES[course_key]
-    subject = course["subjects"][subj_key]
+    entry = CALLBACK_TABLE.get(query.data)
+    if not entry: return SELECTING_ACTION
+    course_key, course, subject, reply_markup = entry
     context.user_data.update({'selected_course': course, 'selected_subject': subject, 'back_to_course_key': course_key})
 
-    keyboard = [
-        [InlineKeyboardButton("🎥 Watch Demo Video", callback_data=f"demo_vid_{course_key}_{subj_key}")],
-        [InlineKeyboardButton("📄 View Demo Material", callback_data=f"demo_mat_{course_key}_{subj_key}")],
-        [InlineKeyboardButton("🛒 Buy Full Course", callback_data="buy_course")],
-        [InlineKeyboardButton("💬 Talk to Admin", callback_data="talk_admin")],
-        [InlineKeyboardButton("⬅️ Back to Subjects", callback_data=course_key)]
-    ]
-    
-    text = (
-        f"📘 <b>{html.escape(course['name'])} &gt; {html.escape(subject['name'])}</b>\n\n"
-        "Evaluate the content quality before you commit. Watch the demo video or read the demo PDF provided by Web Sankul Academy.\n\n"
-        "Choose an action below:"
-    )
-    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    await edit_view(query, context, query.data, text=subject['menu_text'], reply_markup=reply_markup)
     return SELECTING_ACTION
 
+def send_demo(bot, chat_id, msg_id):
+    media = DEMO_MEDIA.get(msg_id)
+    if not media:
+        return bot.copy_message(chat_id=chat_id, from_chat_id=CHANNEL_ID, message_id=msg_id, protect_content=True)
+    media_type, file_id, caption, entities = media
+    if media_type == "video":
+        return bot.send_video(chat_id=chat_id, video=file_id, caption=caption, caption_entities=entities, protect_content=True)
+    return bot.send_document(chat_id=chat_id, document=file_id, caption=caption, caption_entities=entities, protect_content=True)
+
 async def send_demo_content(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    parts = query.data.split('_')
-    course_key = f"{parts[2]}_{parts[3]}"
-    subj_key = f"{parts[4]}_{parts[5]}"
-    subject = COURSES[course_key]["subjects"][subj_key]
-    
-    msg_id = subject["vid_msg_id"] if parts[1] == "vid" else subject["mat_msg_id"]
-    
-    if CHANNEL_ID == 0 or msg_id == 0:
+    # Without a channel no demo can be served, so don't bother resolving the callback
+    if CHANNEL_ID == 0:
         await query.answer("No demo available for this subject yet.", show_alert=True)
         return SELECTING_ACTION
+    entry = CALLBACK_TABLE.get(query.data)
+    if not entry:
+        await query.answer()
+        return SELECTING_ACTION
+    course_key, subject, msg_id = entry
     
-    await query.answer()
+    if msg_id == 0:
+        await query.answer("No demo available for this subject yet.", show_alert=True)
+        return SELECTING_ACTION
     
-    try:
-        await context.bot.copy_message(
-            chat_id=update.effective_chat.id, 
-            from_chat_id=CHANNEL_ID, 
-            message_id=msg_id,
-            protect_content=True 
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("🛒 Purchase Full Course", callback_data="buy_course")],
-            [InlineKeyboardButton("💬 Talk to Admin to Buy", callback_data="talk_admin")],
-            [InlineKeyboardButton("⬅️ Back to Subjects", callback_data=course_key)]
-        ]
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"Liked the demo? Unlock the complete Web Sankul Academy course for {html.escape(COURSES[course_key]['name'])} below:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
-        )
+    # Answer the callback while the demo is sent; the follow-up waits so it lands below the demo
+    chat_id = update.effective_chat.id
+    _, copied = await asyncio.gather(
+        query.answer(),
+        send_demo(context.bot, chat_id, msg_id),
+        return_exceptions=True
+    )
 
-    except Exception as e:
-        logger.error(f"Copy failed: {e}")
+    if isinstance(copied, Exception):
+        logger.error(f"Copy failed: {copied}")
+        # A stale cached file_id shouldn't keep failing; fall back to copy_message next time
+        DEMO_MEDIA.pop(msg_id, None)
         await query.message.reply_text("Sorry, the file could not be loaded. Please ensure the bot is an admin in the private channel.")
+        return SELECTING_ACTION
+
+    if msg_id not in DEMO_MEDIA:
+        # Served by copy_message; try again to cache it so later clicks can use the file_id
+        context.application.create_task(cache_demo_message(context.bot, msg_id))
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=subject['followup_text'],
+        reply_markup=DEMO_FOLLOWUP_MARKUPS[course_key],
+        parse_mode=ParseMode.HTML
+    )
     
     return SELECTING_ACTION
 
@@ -247,23 +500,22 @@ async def handle_buy_or_admin(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     if query.data == "talk_admin":
-        await query.edit_message_text(text="Please type your message and send it. I will forward it to the admin.", parse_mode=ParseMode.HTML)
+        context.user_data.pop('last_view', None)
+        await query.edit_message_text(text="Please type your message and send it. I will forward it to the admin.")
         return FORWARD_TO_ADMIN
     elif query.data == "buy_course":
         course = context.user_data.get('selected_course')
         if not course:
+            context.user_data.pop('last_view', None)
             await query.edit_message_text("Session expired. Please start over using /start.")
             return SELECTING_ACTION
             
-        keyboard = [[InlineKeyboardButton(f"💳 Pay ₹{course['price']} Now", url=RAZORPAY_LINK)],
-                    [InlineKeyboardButton("✅ Already Paid? Share Screenshot", callback_data="share_screenshot")],
-                    [InlineKeyboardButton("⬅️ Back", callback_data=context.user_data['back_to_course_key'])]]
-        buy_text = f"✅ <b>Purchase {html.escape(course['name'])}</b>\n\n<b>Price: ₹{course['price']}</b>\n\nPay via Razorpay and share your screenshot here."
-        
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=buy_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        reply_markup = BUY_MARKUPS[context.user_data['back_to_course_key']]
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=course['buy_text'], reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return SELECTING_ACTION
     elif query.data == "share_screenshot":
-        await query.edit_message_text(text="Please send the screenshot of your payment now.", parse_mode=ParseMode.HTML)
+        context.user_data.pop('last_view', None)
+        await query.edit_message_text(text="Please send the screenshot of your payment now.")
         return FORWARD_SCREENSHOT
 
 # --- Secure Input Handlers ---
@@ -279,8 +531,9 @@ async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user = update.effective_user
     course = context.user_data.get('selected_course', {'name': 'General Query'})
     
-    text = f"📩 <b>New Message</b>\nFrom: {html.escape(user.first_name)} (ID: <code>{user.id}</code>)\nContext: <b>{html.escape(course['name'])}</b>\n\nMessage:\n{html.escape(update.message.text)}"
-    await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode=ParseMode.HTML)
+    text = f"📩 <b>New Message</b>\nFrom: {esc(user.first_name)} (ID: <code>{user.id}</code>)\nContext: <b>{esc(course['name'])}</b>\n\nMessage:\n{html.escape(update.message.text)}"
+    sent = await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode=ParseMode.HTML)
+    remember_forward(context, sent.message_id, user.id)
     
     await update.message.reply_text("✅ Message sent to admin. They will reply to you here shortly.")
     return await start(update, context)
@@ -289,20 +542,31 @@ async def forward_screenshot_to_admin(update: Update, context: ContextTypes.DEFA
     user = update.effective_user
     course = context.user_data.get('selected_course', {'name': 'Unknown'})
     
-    caption = f"📸 <b>Payment Screenshot</b>\nFrom: {html.escape(user.first_name)} (ID: <code>{user.id}</code>)\nCourse: <b>{html.escape(course['name'])}</b>\n\nReply to this message to send the course link."
-    await context.bot.send_photo(chat_id=ADMIN_ID, photo=update.message.photo[-1].file_id, caption=caption, parse_mode=ParseMode.HTML)
+    caption = f"📸 <b>Payment Screenshot</b>\nFrom: {esc(user.first_name)} (ID: <code>{user.id}</code>)\nCourse: <b>{esc(course['name'])}</b>\n\nReply to this message to send the course link."
+    sent = await context.bot.send_photo(chat_id=ADMIN_ID, photo=update.message.photo[-1].file_id, caption=caption, parse_mode=ParseMode.HTML)
+    remember_forward(context, sent.message_id, user.id)
     
     await update.message.reply_text("✅ Screenshot received. The admin will verify it and send you the access link soon.")
     return await start(update, context)
 
 # --- 2-Way Chat & Admin Broadcast ---
+def remember_forward(context: ContextTypes.DEFAULT_TYPE, message_id, user_id):
+    # Admin-side message_id -> user_id, so replies don't need to parse the message text
+    forwards = context.bot_data.setdefault('admin_fwd_map', collections.OrderedDict())
+    forwards[message_id] = user_id
+    if len(forwards) > ADMIN_FWD_MAP_SIZE:
+        forwards.popitem(last=False)
+
 async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_ID or not update.message.reply_to_message: return
-    orig = update.message.reply_to_message.text or update.message.reply_to_message.caption
+    replied = update.message.reply_to_message
+    user_id = context.bot_data.get('admin_fwd_map', {}).get(replied.message_id)
+    orig = replied.text or replied.caption
     
-    if orig and "(ID: " in orig:
+    if user_id or (orig and "(ID: " in orig):
         try:
-            user_id = int(orig.split("(ID: ")[1].split(")")[0].replace('`', ''))
+            if not user_id:
+                user_id = int(USER_ID_RE.search(orig).group(1))
             text = f"👑 <b>Admin replied:</b>\n\n{html.escape(update.message.text)}\n\n---\n<i>You can reply to this message to chat back.</i>"
             await context.bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.HTML)
             await update.message.reply_text("✅ Reply sent successfully.")
@@ -310,12 +574,17 @@ async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"Error extracting user ID: {e}")
             await update.message.reply_text("❌ Failed to parse User ID.")
 
+class AdminReplyFilter(filters.MessageFilter):
+    # Matches replies to the bot's "Admin replied:" messages, checked before any handler task is scheduled
+    def filter(self, message):
+        replied = message.reply_to_message
+        return bool(replied and replied.from_user and replied.from_user.is_bot and replied.text and "Admin replied:" in replied.text)
+
 async def handle_user_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    replied = update.message.reply_to_message
-    if replied and replied.from_user.is_bot and "Admin replied:" in (replied.text or ""):
-        text = f"↪️ <b>Follow-up</b> from {html.escape(update.effective_user.first_name)} (ID: <code>{update.effective_user.id}</code>):\n\n{html.escape(update.message.text)}"
-        await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode=ParseMode.HTML)
-        await update.message.reply_text("✅ Your reply has been sent to the admin.")
+    text = f"↪️ <b>Follow-up</b> from {esc(update.effective_user.first_name)} (ID: <code>{update.effective_user.id}</code>):\n\n{html.escape(update.message.text)}"
+    sent = await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode=ParseMode.HTML)
+    remember_forward(context, sent.message_id, update.effective_user.id)
+    await update.message.reply_text("✅ Your reply has been sent to the admin.")
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_ID:
@@ -332,39 +601,103 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("❌ Database not connected. Cannot fetch users.")
         return
         
-    async with pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        
-    if not users:
-        await update.message.reply_text("No users found in the database.")
-        return
-        
+    # A broadcast takes about a minute per 2k users; running it as a task frees the admin's
+    # chat (and its update slot) straight away instead of holding them until the last send
+    context.application.create_task(run_broadcast(context.bot, pool, message), update=update)
+    await update.message.reply_text("📢 Broadcast started. You'll get a summary here when it finishes.")
+
+async def run_broadcast(bot, pool, message):
+    send = functools.partial(
+        bot.send_message,
+        text=f"📢 <b>Announcement:</b>\n\n{html.escape(message)}",
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True
+    )
+    queue = asyncio.Queue(maxsize=BROADCAST_BATCH)
     success_count = 0
-    for user in users:
-        try:
-            await context.bot.send_message(
-                chat_id=user['user_id'], 
-                text=f"📢 <b>Announcement:</b>\n\n{html.escape(message)}", 
-                parse_mode=ParseMode.HTML
-            )
-            success_count += 1
-        except Exception as e:
-            logger.warning(f"Failed to send broadcast to {user['user_id']}: {e}")
-            
-    await update.message.reply_text(f"✅ Broadcast complete. Successfully sent to {success_count}/{len(users)} users.")
+    total = 0
+    dead_users = []
+
+    async def _send(user_id):
+        for _ in range(BROADCAST_RETRIES):
+            try:
+                await send(chat_id=user_id)
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+        logger.warning(f"Gave up on broadcast to {user_id} after {BROADCAST_RETRIES} rate-limit retries")
+        return False
+
+    async def _worker():
+        nonlocal success_count
+        while True:
+            user_id = await queue.get()
+            try:
+                if await _send(user_id):
+                    success_count += 1
+            except Forbidden:
+                # Blocked the bot or deleted their account; drop them so later broadcasts skip them
+                dead_users.append(user_id)
+            except Exception as e:
+                logger.warning(f"Failed to send broadcast to {user_id}: {e}")
+            finally:
+                queue.task_done()
+                # Each worker sends at most once a second, so all workers together stay at the global limit
+                await asyncio.sleep(1)
+
+    # Page through recipients by primary key so sending starts after the first batch. Each page
+    # is its own short query; no connection or transaction stays open while the queue drains.
+    workers = [asyncio.create_task(_worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        last_id = 0
+        while True:
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                    last_id, BROADCAST_BATCH
+                )
+            for record in rows:
+                await queue.put(record['user_id'])
+            total += len(rows)
+            if len(rows) < BROADCAST_BATCH: break
+            last_id = rows[-1]['user_id']
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    if not total:
+        await bot.send_message(chat_id=ADMIN_ID, text="No users found in the database.")
+        return
+
+    if dead_users:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM users WHERE user_id = ANY($1::bigint[])", dead_users)
+        for user_id in dead_users:
+            _seen_users.pop(user_id, None)
+
+    await bot.send_message(
+        chat_id=ADMIN_ID,
+        text=f"✅ Broadcast complete. Successfully sent to {success_count}/{total} users."
+        + (f"\nRemoved {len(dead_users)} users who blocked the bot." if dead_users else "")
+    )
 
 # --- System & Setup ---
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id != ADMIN_ID: return
     pool = context.bot_data['db_pool']
+    # One round-trip: the user total comes back as the first row (k = 0)
     async with pool.acquire() as conn:
-        user_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-        stats = await conn.fetch("SELECT action, count FROM stats ORDER BY count DESC")
+        rows = await conn.fetch(
+            "SELECT 0 AS k, NULL AS action, COUNT(*) AS count FROM users "
+            "UNION ALL SELECT 1, action, count FROM stats "
+            "ORDER BY k, count DESC"
+        )
+    user_count, stats = rows[0]['count'], rows[1:]
+    
+    header = f"📊 <b>Database Stats</b>\n\n<b>Total Registered Users:</b> <code>{user_count}</code>\n\n<b>Interactions:</b>\n"
+    text = header + "".join(f"- {html.escape(row['action'])}: <code>{row['count']}</code>\n" for row in stats)
     
-    text = f"📊 <b>Database Stats</b>\n\n<b>Total Registered Users:</b> <code>{user_count}</code>\n\n<b>Interactions:</b>\n"
-    for row in stats:
-        text += f"- {html.escape(row['action'])}: <code>{row['count']}</code>\n"
-        
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -380,14 +713,57 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.error(f"Failed to send error to admin: {e}")
 
 async def post_init(application: Application):
+    # In webhook mode PTB's own server owns PORT and keeps it answering
+    if not WEBHOOK_URL:
+        application.bot_data['web_server'] = await start_web_server()
     if DATABASE_URL:
-        pool = await asyncpg.create_pool(DATABASE_URL)
+        if DB_POOLER:
+            # pgbouncer transaction pooling can't keep prepared statements; close idle conns so Neon can suspend
+            pool_options = dict(min_size=1, max_inactive_connection_lifetime=10, statement_cache_size=0)
+        else:
+            pool_options = dict(min_size=5, max_inactive_connection_lifetime=300, statement_cache_size=1024)
+        pool = await asyncpg.create_pool(DATABASE_URL, max_size=20, command_timeout=10, **pool_options)
         application.bot_data['db_pool'] = pool
         await init_db(pool)
+        application.bot_data['vacuum_task'] = asyncio.create_task(vacuum_users(pool))
+        application.bot_data['flush_task'] = asyncio.create_task(flush_loop(pool))
+    if CHANNEL_ID:
+        application.bot_data['demo_cache_task'] = asyncio.create_task(cache_demo_media(application.bot))
+
+async def post_stop(application: Application):
+    # Stopped while the bot can still make requests, so a caching pass can't outlive it
+    demo_cache_task = application.bot_data.get('demo_cache_task')
+    if demo_cache_task:
+        demo_cache_task.cancel()
+        await asyncio.gather(demo_cache_task, return_exceptions=True)
+
+async def post_shutdown(application: Application):
+    if 'web_server' in application.bot_data:
+        application.bot_data['web_server'].close()
+    pool = application.bot_data.get('db_pool')
+    if not pool: return
+    # Either task may be missing if post_init failed part-way (e.g. in init_db).
+    # The pool can't close while the vacuum still holds a connection.
+    for name in ('vacuum_task', 'flush_task'):
+        task = application.bot_data.get(name)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await flush_all(pool)
+    await pool.close()
 
 def main() -> None:
-    threading.Thread(target=run_web_server, daemon=True).start()
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .build()
+    )
     
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -417,10 +793,19 @@ def main() -> None:
     application.add_handler(CommandHandler("stats", show_stats))
     application.add_handler(CommandHandler("broadcast", broadcast)) 
     application.add_handler(MessageHandler(filters.REPLY & filters.User(ADMIN_ID), reply_to_user))
-    application.add_handler(MessageHandler(filters.REPLY & ~filters.COMMAND, handle_user_reply))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND & AdminReplyFilter(), handle_user_reply))
     application.add_error_handler(error_handler)
     
-    application.run_polling()
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()